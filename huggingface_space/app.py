@@ -1,31 +1,125 @@
 
 import os
-import io
-import base64
+import asyncio
+import fcntl
+import hmac
+import importlib.util
 import json
+import shutil
+import tempfile
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
+import pybase64
 import cv2
-from PIL import Image
-from fastapi import FastAPI, UploadFile, HTTPException, Depends, Header
-from pydantic import BaseModel
+from fastapi import FastAPI, UploadFile, HTTPException, Depends, Header, File, Form
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
 from typing import List, Optional, Tuple
+import torch
 from ultralytics import YOLO
-from shapely.geometry import Point, Polygon
-from shapely.ops import unary_union
+import shapely
+from shapely.geometry import Polygon
 
-app = FastAPI()
+from kernels import pairwise_iou, pip_mask
+
+@asynccontextmanager
+async def lifespan(app):
+    # The batcher task lives on the server's event loop for the app's lifetime
+    batcher.start()
+    yield
+    await batcher.stop()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # --- Config ---
 API_SECRET = os.getenv("API_SECRET", "default_secret_123")
 MODEL_NAME = "yolov8n.pt"  # Nano model for speed
+IMG_SIZE = 640  # Common inference size so all frames stack into one batch
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+USE_TENSORRT = os.getenv("USE_TENSORRT", "0") == "1"  # Opt-in FP16 engine on GPU hosts, needs the tensorrt package
+ENGINE_NAME = MODEL_NAME.replace(".pt", ".engine")
+MAX_BATCH = 16  # Upper bound of the engine's dynamic batch profile
+USE_INT8 = os.getenv("USE_INT8", "0") == "1"  # Opt-in INT8 ONNX Runtime model on CPU-only hosts
+INT8_NAME = MODEL_NAME.replace(".pt", "_int8.onnx")
+CALIBRATION_DIR = os.getenv("CALIBRATION_DIR")  # Camera frames for INT8 calibration, required with USE_INT8
+BATCH_WAIT_S = 0.005  # How long the batcher waits for more frames from concurrent requests
+BATCH_TIMEOUT_S = 30.0  # Upper bound on a request's wait for its batch results
+PIP_MAX_VERTICES = 64  # Larger zones use Shapely's prepared (edge-indexed) polygon
+LOCK_NAME = "model.lock"  # Serializes model download/export across Uvicorn workers
+
+@contextmanager
+def model_lock():
+    # Workers start together: the first one exports, the rest wait and load its result
+    with open(LOCK_NAME, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def export_atomic(target, export):
+    # export(tmp_dir) -> built file; moved into place with os.replace, so a crash
+    # mid-export never leaves a partial file that later starts would take as done
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        os.replace(export(tmp_dir), target)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_model():
+    # -> (model, backend name)
+    if DEVICE == "cuda" and USE_TENSORRT:
+        try:
+            # Not in requirements.txt (several GB); fail here instead of letting Ultralytics pip-install it
+            if importlib.util.find_spec("tensorrt") is None:
+                raise ImportError("tensorrt is not installed")
+            # Built once on first GPU start, then reused from disk
+            if not os.path.exists(ENGINE_NAME):
+                print(f"Exporting TensorRT FP16 engine {ENGINE_NAME}...")
+                export_atomic(ENGINE_NAME, lambda d: YOLO(shutil.copy(YOLO(MODEL_NAME).ckpt_path, d)).export(
+                    format="engine", half=True, dynamic=True, simplify=False,
+                    batch=MAX_BATCH, imgsz=IMG_SIZE, device=0))
+            print(f"Loading engine {ENGINE_NAME}...")
+            return YOLO(ENGINE_NAME, task="detect"), "TensorRT FP16"
+        except Exception as e:
+            print(f"TensorRT unavailable, falling back to PyTorch: {e}")
+
+    if DEVICE == "cpu" and USE_INT8:
+        try:
+            # Quantized once on first CPU start, then reused from disk
+            if not os.path.exists(INT8_NAME):
+                from quantize import export_int8_onnx
+                print(f"Exporting INT8 ONNX model {INT8_NAME}...")
+                export_atomic(INT8_NAME, lambda d: export_int8_onnx(
+                    MODEL_NAME, os.path.join(d, INT8_NAME), IMG_SIZE, CALIBRATION_DIR))
+            print(f"Loading INT8 model {INT8_NAME}...")
+            return YOLO(INT8_NAME, task="detect"), "ONNX Runtime INT8"
+        except Exception as e:
+            print(f"INT8 ONNX unavailable, falling back to PyTorch: {e}")
+
+    print(f"Loading model {MODEL_NAME} on {DEVICE}...")
+    m = YOLO(MODEL_NAME)
+    m.fuse()
+    m.to(DEVICE)
+    return m, f"PyTorch ({DEVICE})"
+
+with model_lock():
+    model, MODEL_BACKEND = load_model()
+print(f"Model loaded, backend: {MODEL_BACKEND}")
+
+# Class ids resolved once so the hot path only does integer lookups
+TARGET_CLASSES = {'person', 'car', 'motorcycle', 'truck', 'bus'}
+KEEP_IDS = {i for i, n in model.names.items() if n in TARGET_CLASSES}
+ID_TO_NAME = {i: model.names[i] for i in KEEP_IDS}
+KEEP_ID_ARRAY = np.array(sorted(KEEP_IDS), dtype=np.int16)  # For np.isin masks
+PERSON_ID = next(i for i in KEEP_IDS if ID_TO_NAME[i] == 'person')
+VEHICLE_IDS = KEEP_IDS - {PERSON_ID}
 
-print(f"Loading model {MODEL_NAME}...")
-model = YOLO(MODEL_NAME)
-print("Model loaded.")
+# One thread owns the model (YOLO calls are not thread-safe), fed only by the batcher
+INFERENCE_POOL = ThreadPoolExecutor(max_workers=1)
+CPU_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())  # Decode + analysis, cv2/numba release the GIL
 
 # --- Models ---
-class DetectionRequest(BaseModel):
-    images: List[str]  # Base64 encoded images
+class DetectionSettings(BaseModel):
     camera_name: str
     zone_points: Optional[List[List[float]]] = None # [[x,y], [x,y]] normalized 0-1
     # Dynamic Settings
@@ -33,6 +127,9 @@ class DetectionRequest(BaseModel):
     vehicle_iou_threshold: Optional[float] = 0.9
     ignore_moving_persons: Optional[bool] = True
 
+class DetectionRequest(DetectionSettings):
+    images: List[str]  # Base64 encoded images
+
 class AnalysisResult(BaseModel):
     shouldAlert: bool
     description: str
@@ -40,199 +137,335 @@ class AnalysisResult(BaseModel):
     detectedObjects: List[str]
 
 # --- Auth ---
+@lru_cache(maxsize=64)
+def is_valid_token(token: str) -> bool:
+    # Constant-time compare, memoized per token string
+    return hmac.compare_digest(token.encode(), API_SECRET.encode())
+
 async def verify_token(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Invalid header format")
     token = authorization.split(" ")[1]
-    if token != API_SECRET:
+    if not is_valid_token(token):
         raise HTTPException(status_code=401, detail="Invalid API Secret")
     return token
 
 # --- Helpers ---
+def bytes_to_cv2(image_data):
+    # Decode straight to BGR, no PIL round-trip or channel swap
+    img = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return img
+
 def base64_to_cv2(b64_str):
-    image_data = base64.b64decode(b64_str)
-    image = Image.open(io.BytesIO(image_data))
-    return cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-
-def calculate_iou(box1, box2):
-    # box: [x1, y1, x2, y2]
-    xA = max(box1[0], box2[0])
-    yA = max(box1[1], box2[1])
-    xB = min(box1[2], box2[2])
-    yB = min(box1[3], box2[3])
-
-    interArea = max(0, xB - xA) * max(0, yB - yA)
-    box1Area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2Area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-
-    iou = interArea / float(box1Area + box2Area - interArea)
-    return iou
-
-def is_inside_zone(box, zone_poly: Polygon, width, height):
-    if not zone_poly or zone_poly.is_empty:
-        return True # No zone defined = everywhere is valid
+    # SIMD base64 decode (pybase64), same result as base64.b64decode
+    return bytes_to_cv2(pybase64.b64decode(b64_str, validate=False))
+
+def letterbox(img, size=IMG_SIZE):
+    # Resize keeping aspect ratio, pad to size x size -> (image, (scale, pad_x, pad_y, orig_w, orig_h))
+    h, w = img.shape[:2]
+    scale = min(size / w, size / h)
+    new_w, new_h = max(1, round(w * scale)), max(1, round(h * scale))  # Never 0 for extreme aspect ratios
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    pad_x = (size - new_w) // 2
+    pad_y = (size - new_h) // 2
+    img = cv2.copyMakeBorder(img, pad_y, size - new_h - pad_y, pad_x, size - new_w - pad_x,
+                             cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return img, (scale, pad_x, pad_y, w, h)
+
+def load_frame(decode, data):
+    # Decode and letterbox once, so frames are already model-sized and stack trivially
+    return letterbox(decode(data))
+
+def best_match(a, b, min_iou=0.1):
+    # Best IOU partner in b (non-empty) for each box in a -> (matched rows of a, their index in b)
+    iou = pairwise_iou(a, b)
+    best = iou.argmax(axis=1)
+    rows = np.where(iou[np.arange(len(a)), best] > min_iou)[0]
+    return rows, best[rows]
+
+@lru_cache(maxsize=256)
+def build_zone(points):
+    # points: tuple of (x, y) normalized 0-1 -> (bounds, vx, vy, prepared polygon or None), None if empty
+    zone_poly = Polygon(points)
+    if zone_poly.is_empty:
+        return None
+    vertices = np.asarray(points, dtype=np.float32)
+    zone_prep = None
+    if len(vertices) > PIP_MAX_VERTICES:
+        shapely.prepare(zone_poly)
+        zone_prep = zone_poly
+    return zone_poly.bounds, vertices[:, 0], vertices[:, 1], zone_prep
+
+def filter_in_zone(boxes, width, height, zone_bounds, vx, vy, zone_prep=None):
+    # Zone test for all boxes of a frame at once, centroids normalized 0-1
+    cx = ((boxes[:, 0] + boxes[:, 2]) / 2 / width).astype(np.float32)
+    cy = ((boxes[:, 1] + boxes[:, 3]) / 2 / height).astype(np.float32)
+
+    # Cheap bounding-box reject before the exact polygon test
+    zmin_x, zmin_y, zmax_x, zmax_y = zone_bounds
+    mask = (cx >= zmin_x) & (cx <= zmax_x) & (cy >= zmin_y) & (cy <= zmax_y)
+    if mask.any():
+        if zone_prep is not None:
+            # Vectorized GEOS test on raw coordinates, no Point per box
+            mask[mask] = shapely.contains_xy(zone_prep, cx[mask], cy[mask])
+        else:
+            mask[mask] = pip_mask(cx[mask], cy[mask], vx, vy)
+    return mask
+
+# --- Batching ---
+def run_model(batch):
+    # Single-threaded model call, chunked to fit the engine's batch profile
+    results_list = []
+    for i in range(0, len(batch), MAX_BATCH):
+        results_list.extend(model(batch[i:i + MAX_BATCH], verbose=False, imgsz=IMG_SIZE, device=DEVICE))
+    return results_list
+
+class InferenceBatcher:
+    # Coalesces frames of concurrent requests into one model call, then splits results back
+    def __init__(self, max_frames=MAX_BATCH, max_wait=BATCH_WAIT_S):
+        self.max_frames = max_frames
+        self.max_wait = max_wait
+        self.queue = None  # Created in start() so it binds to the server's event loop
+        self.task = None
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+        self.task.add_done_callback(self._on_done)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    def _on_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Inference batcher stopped: {task.exception()!r}")
+
+    async def submit(self, imgs):
+        if self.task is None or self.task.done():
+            # Never started or died; restart so queued and new requests are not stranded
+            print("Inference batcher not running, restarting")
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((future, imgs))
+        # On timeout wait_for cancels the future, and run() skips futures already done
+        return await asyncio.wait_for(future, BATCH_TIMEOUT_S)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        carry = None  # Item that would have overflowed the previous batch
+        while True:
+            pending = [carry if carry is not None else await self.queue.get()]
+            carry = None
+            n_frames = len(pending[0][1])
+            if n_frames < self.max_frames:
+                await asyncio.sleep(self.max_wait)  # Let concurrent requests join this batch
+            while n_frames < self.max_frames and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item[0].done():
+                    continue
+                if n_frames + len(item[1]) > self.max_frames:
+                    carry = item  # Opens the next batch, so this one fits the engine's batch profile
+                    break
+                pending.append(item)
+                n_frames += len(item[1])
+
+            # Requests that already timed out are shed, not inferred for nobody
+            pending = [(future, imgs) for future, imgs in pending if not future.done()]
+            if not pending:
+                continue
+            batch = [img for _, imgs in pending for img in imgs]
+            try:
+                results_list = await loop.run_in_executor(INFERENCE_POOL, run_model, batch)
+            except Exception as e:
+                for future, _ in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for future, imgs in pending:
+                if not future.done():
+                    future.set_result(results_list[start:start + len(imgs)])
+                start += len(imgs)
+
+batcher = InferenceBatcher()
+
+# --- Core Logic ---
+def _analyze_sync(payload: DetectionSettings, transforms, results_list):
+    # Prepare Zone (cached, a camera's zone rarely changes)
+    zone = None
+    if payload.zone_points and len(payload.zone_points) >= 3:
+        zone = build_zone(tuple((round(x, 4), round(y, 4)) for x, y in payload.zone_points))
+        print(f"Zone defined: {len(payload.zone_points)} points")
     
-    # Calculate centroid
-    cx = (box[0] + box[2]) / 2 / width
-    cy = (box[1] + box[3]) / 2 / height
+    frames_detections = [] # (boxes float32[N,4], cls int16[N], conf float32[N]) for each frame
     
-    point = Point(cx, cy)
-    return zone_poly.contains(point)
+    # 1. Collect detections of all frames
+    for (scale, pad_x, pad_y, w, h), results in zip(transforms, results_list):
+        boxes = results.boxes.xyxy.cpu().numpy().astype(np.float32)
+        cls = results.boxes.cls.cpu().numpy().astype(np.int16)
+        conf = results.boxes.conf.cpu().numpy().astype(np.float32)
 
-# --- Core Logic ---
-@app.post("/detect", response_model=AnalysisResult)
-async def detect(payload: DetectionRequest, token: str = Depends(verify_token)):
-    try:
-        if len(payload.images) == 0:
-            return AnalysisResult(shouldAlert=False, description="No images provided", confidence=0, detectedObjects=[])
+        # Undo the letterbox: model-input coordinates -> original frame pixels
+        boxes = (boxes - np.float32([pad_x, pad_y, pad_x, pad_y])) / np.float32(scale)
 
-        print(f"Processing {len(payload.images)} frames from {payload.camera_name}")
-        
-        # Prepare Zone
-        zone_poly = None
-        if payload.zone_points and len(payload.zone_points) >= 3:
-            zone_poly = Polygon(payload.zone_points)
-            print(f"Zone defined: {len(payload.zone_points)} points")
-        
-        frames_detections = [] # [{class: 'person', box: [...], conf: 0.9}, ...] for each frame
-        
-        # 1. Run Detection on all frames
-        for b64 in payload.images:
-            img = base64_to_cv2(b64)
-            h, w = img.shape[:2]
-            results = model(img, verbose=False)[0]
-            
-            frame_dets = []
-            for box in results.boxes:
-                cls_id = int(box.cls[0])
-                cls_name = model.names[cls_id]
-                conf = float(box.conf[0])
-                xyxy = box.xyxy[0].tolist()
-                
-                # Filter useful classes
-                if cls_name not in ['person', 'car', 'motorcycle', 'truck', 'bus']:
-                    continue
-                
-                # Check Zone
-                if zone_poly and not is_inside_zone(xyxy, zone_poly, w, h):
-                    continue
+        # Filter useful classes
+        keep = np.isin(cls, KEEP_ID_ARRAY)
+
+        # Check Zone for the whole frame in one pass
+        if zone is not None and keep.any():
+            keep[keep] = filter_in_zone(boxes[keep], w, h, *zone)
+        frames_detections.append((boxes[keep], cls[keep], conf[keep]))
+
+    # 2. Analyze Behavior across frames
+    # We need at least 3 frames for reliable movement analysis
+    if len(frames_detections) < 3:
+         # Fallback: Just report presence if any important object found in last frame
+         _, last_cls, last_conf = frames_detections[-1]
+         if len(last_cls):
+             det_names = list(dict.fromkeys(ID_TO_NAME[c] for c in last_cls.tolist()))
+             return AnalysisResult(
+                 shouldAlert=True,
+                 description=f"Phát hiện: {', '.join(det_names)} (Không đủ ảnh để phân tích hành vi)",
+                 confidence=float(last_conf[0]) * 100,
+                 detectedObjects=det_names
+             )
+         else:
+             return AnalysisResult(shouldAlert=False, description="Không phát hiện đối tượng", confidence=0, detectedObjects=[])
+
+    # Track objects across frames (Simple greedy matching by IOU)
+    # We focus on the "most prominent" object chain
+    
+    # Count objects over all frames
+    if not any(len(cls) for _, cls, _ in frames_detections):
+         return AnalysisResult(shouldAlert=False, description="Không phát hiện đối tượng trong vùng", confidence=0, detectedObjects=[])
+
+    # Prioritize Person Logic then Vehicle Logic
+    has_person = any((cls == PERSON_ID).any() for _, cls, _ in frames_detections)
+    
+    alerts = []
+
+    # Simple Logic: Check consistency of positions for each object "trace"
+    # Since we don't have a tracker ID, we assume object 1 in frame 1 maps to object 1 in frame 2 if IOU is high
+    
+    # Calculate max confidence from ALL objects in chain
+    max_conf = max(float(conf.max()) for _, _, conf in frames_detections if len(conf))
+
+    # Vectorized IOU matching: frame 1 -> frame 2 -> frame 3
+    boxes_f1, cls_f1, _ = frames_detections[0]
+    boxes_f2, cls_f2, _ = frames_detections[1]
+    boxes_f3, cls_f3, _ = frames_detections[2]
+    detected_types = dict.fromkeys(ID_TO_NAME[c] for c in cls_f1.tolist())  # Ordered, deduplicated
+
+    # Only classes present in all 3 frames can form a chain; an empty frame 1 skips matching entirely
+    chain_ids = np.intersect1d(np.intersect1d(cls_f1, cls_f2), cls_f3).tolist() if len(cls_f1) else []
+    for cls_id in chain_ids:
+        obj_class = ID_TO_NAME[cls_id]
+        # max_conf updated above globally
+
+        b1 = boxes_f1[cls_f1 == cls_id]
+        b2 = boxes_f2[cls_f2 == cls_id]
+        b3 = boxes_f3[cls_f3 == cls_id]
+
+        # Chain frame 1 -> 2 -> 3 through the best match above a loose IOU
+        rows_12, idx_2 = best_match(b1, b2) # Loose match
+        rows_23, idx_3 = best_match(b2[idx_2], b3)
+        chain_1 = rows_12[rows_23]
+
+        # We have chains of 3 frames
+        # Calculate Intersection of all 3
+        iou_13 = pairwise_iou(b1[chain_1], b3[idx_3]).diagonal()
+
+        for iou_1_3 in iou_13.tolist():
+            # RULES
+            if cls_id == PERSON_ID:
+                # Use dynamic settings
+                threshold = payload.person_iou_threshold if payload.person_iou_threshold is not None else 0.6
+                ignore_moving = payload.ignore_moving_persons if payload.ignore_moving_persons is not None else True
                 
-                frame_dets.append({
-                    "class": cls_name,
-                    "box": xyxy,
-                    "conf": conf
-                })
-            frames_detections.append(frame_dets)
-
-        # 2. Analyze Behavior across frames
-        # We need at least 3 frames for reliable movement analysis
-        if len(frames_detections) < 3:
-             # Fallback: Just report presence if any important object found in last frame
-             last_frame_dets = frames_detections[-1] if frames_detections else []
-             if last_frame_dets:
-                 det_names = list(set([d['class'] for d in last_frame_dets]))
-                 return AnalysisResult(
-                     shouldAlert=True,
-                     description=f"Phát hiện: {', '.join(det_names)} (Không đủ ảnh để phân tích hành vi)",
-                     confidence=last_frame_dets[0]['conf'] * 100,
-                     detectedObjects=det_names
-                 )
-             else:
-                 return AnalysisResult(shouldAlert=False, description="Không phát hiện đối tượng", confidence=0, detectedObjects=[])
-
-        # Track objects across frames (Simple greedy matching by IOU)
-        # We focus on the "most prominent" object chain
-        
-        # Flatten and count classes
-        all_objs = [d for frame in frames_detections for d in frame]
-        if not all_objs:
-             return AnalysisResult(shouldAlert=False, description="Không phát hiện đối tượng trong vùng", confidence=0, detectedObjects=[])
-
-        # Prioritize Person Logic then Vehicle Logic
-        has_person = any(d['class'] == 'person' for d in all_objs)
-        
-        alerts = []
-        max_conf = 0
-        detected_types = set()
-
-        # Simple Logic: Check consistency of positions for each object "trace"
-        # Since we don't have a tracker ID, we assume object 1 in frame 1 maps to object 1 in frame 2 if IOU is high
-        
-        first_frame_dets = frames_detections[0]
-        
-        # Calculate max confidence from ALL objects in chain
-        for d in all_objs:
-             max_conf = max(max_conf, d['conf'])
-
-        for bet in first_frame_dets:
-            obj_class = bet['class']
-            box = bet['box']
-            detected_types.add(obj_class)
-            # max_conf updated above globally
-            
-            # Try to match in Frame 2 and Frame 3
-            match_f2 = None
-            for det2 in frames_detections[1]:
-                if det2['class'] == obj_class and calculate_iou(box, det2['box']) > 0.1: # Loose match
-                    match_f2 = det2
-                    break
-            
-            match_f3 = None
-            if match_f2:
-                 for det3 in frames_detections[2]:
-                    if det3['class'] == obj_class and calculate_iou(match_f2['box'], det3['box']) > 0.1:
-                        match_f3 = det3
-                        break
+                if iou_1_3 > threshold:
+                    alerts.append(f"Có người lảng vảng/đứng yên ({int(iou_1_3*100)}% > {int(threshold*100)}%)")
+                elif not ignore_moving:
+                    alerts.append(f"Người đang di chuyển (IOU: {iou_1_3:.2f})")
+                else:
+                    print(f"Ignored moving person (IOU: {iou_1_3:.2f})")
             
-            if match_f2 and match_f3:
-                # We have a chain of 3 frames
-                # Calculate Intersection of all 3
-                iou_1_3 = calculate_iou(box, match_f3['box'])
+            elif cls_id in VEHICLE_IDS:
+                threshold = payload.vehicle_iou_threshold if payload.vehicle_iou_threshold is not None else 0.9
                 
-                # RULES
-                if obj_class == 'person':
-                    # Use dynamic settings
-                    threshold = payload.person_iou_threshold if payload.person_iou_threshold is not None else 0.6
-                    ignore_moving = payload.ignore_moving_persons if payload.ignore_moving_persons is not None else True
-                    
-                    if iou_1_3 > threshold:
-                        alerts.append(f"Có người lảng vảng/đứng yên ({int(iou_1_3*100)}% > {int(threshold*100)}%)")
-                    elif not ignore_moving:
-                        alerts.append(f"Người đang di chuyển (IOU: {iou_1_3:.2f})")
-                    else:
-                        print(f"Ignored moving person (IOU: {iou_1_3:.2f})")
-                
-                elif obj_class in ['car', 'motorcycle', 'truck', 'bus']:
-                    threshold = payload.vehicle_iou_threshold if payload.vehicle_iou_threshold is not None else 0.9
-                    
-                    if iou_1_3 > threshold:
-                         alerts.append(f"{obj_class} đỗ trái phép/dừng lâu ({int(iou_1_3*100)}%)")
-                    else:
-                        print(f"Ignored moving vehicle (IOU: {iou_1_3:.2f})")
-
-        if not alerts:
-             # Objects found but didn't trigger specific rules (e.g. moving cars)
-             # If Person was found but logic failed (maybe lost tracking), still alert "Person detected"
-             if has_person:
-                 return AnalysisResult(
-                    shouldAlert=True, 
-                    description="Phát hiện người (Chuyển động không rõ)", 
-                    confidence=max_conf * 100, 
-                    detectedObjects=list(detected_types)
-                )
-             return AnalysisResult(shouldAlert=False, description="Xe cộ di chuyển (Bỏ qua)", confidence=0, detectedObjects=list(detected_types))
-        
-        # Consolidate Alerts
-        unique_alerts = list(set(alerts))
-        final_desc = ", ".join(unique_alerts)
-        
-        return AnalysisResult(
-            shouldAlert=True,
-            description=final_desc,
-            confidence=max_conf * 100,
-            detectedObjects=list(detected_types)
-        )
+                if iou_1_3 > threshold:
+                     alerts.append(f"{obj_class} đỗ trái phép/dừng lâu ({int(iou_1_3*100)}%)")
+                else:
+                    print(f"Ignored moving vehicle (IOU: {iou_1_3:.2f})")
+
+    if not alerts:
+         # Objects found but didn't trigger specific rules (e.g. moving cars)
+         # If Person was found but logic failed (maybe lost tracking), still alert "Person detected"
+         if has_person:
+             return AnalysisResult(
+                shouldAlert=True, 
+                description="Phát hiện người (Chuyển động không rõ)", 
+                confidence=max_conf * 100, 
+                detectedObjects=list(detected_types)
+            )
+         return AnalysisResult(shouldAlert=False, description="Xe cộ di chuyển (Bỏ qua)", confidence=0, detectedObjects=list(detected_types))
+    
+    # Consolidate Alerts
+    unique_alerts = list(dict.fromkeys(alerts))  # Class-id order: chain_ids comes sorted from np.intersect1d
+    final_desc = ", ".join(unique_alerts)
+    
+    return AnalysisResult(
+        shouldAlert=True,
+        description=final_desc,
+        confidence=max_conf * 100,
+        detectedObjects=list(detected_types)
+    )
 
+async def _detect(payload: DetectionSettings, images, decode):
+    # images: encoded frames, turned into BGR arrays by decode (base64_to_cv2 / bytes_to_cv2)
+    try:
+        if len(images) == 0:
+            return AnalysisResult(shouldAlert=False, description="No images provided", confidence=0, detectedObjects=[])
+
+        print(f"Processing {len(images)} frames from {payload.camera_name}")
+
+        # Blocking work stays off the event loop: parallel decode, shared batched inference, analysis
+        loop = asyncio.get_running_loop()
+        frames = await asyncio.gather(*(loop.run_in_executor(CPU_POOL, load_frame, decode, b) for b in images))
+        imgs = [img for img, _ in frames]
+        transforms = [t for _, t in frames]
+        results_list = await batcher.submit(imgs)
+        return await loop.run_in_executor(CPU_POOL, _analyze_sync, payload, transforms, results_list)
+
+    except asyncio.TimeoutError:
+        print(f"Timeout: no inference results within {BATCH_TIMEOUT_S}s")
+        return AnalysisResult(shouldAlert=False, description=f"Server Error: inference timed out after {BATCH_TIMEOUT_S}s (server overloaded)", confidence=0, detectedObjects=[])
     except Exception as e:
         print(f"Error: {e}")
         return AnalysisResult(shouldAlert=False, description=f"Server Error: {str(e)}", confidence=0, detectedObjects=[])
+
+@app.post("/detect", response_model=AnalysisResult, deprecated=True)
+async def detect(payload: DetectionRequest, token: str = Depends(verify_token)):
+    # Base64 JSON path, kept for existing clients; prefer /detect_multipart
+    return await _detect(payload, payload.images, base64_to_cv2)
+
+@app.post("/detect_multipart", response_model=AnalysisResult)
+async def detect_multipart(files: List[UploadFile] = File(...), settings: str = Form(...),
+                           token: str = Depends(verify_token)):
+    # Raw JPEG parts, no base64 inflation or decode; settings is a DetectionSettings JSON string
+    try:
+        payload = DetectionSettings(**json.loads(settings))
+    except (ValueError, TypeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid settings: {e}")
+    images = [await f.read() for f in files]
+    return await _detect(payload, images, bytes_to_cv2)
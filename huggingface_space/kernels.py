@@ -0,0 +1,45 @@
+
+# Numba-compiled geometry kernels used by the /detect hot path.
+# Signatures are given explicitly, so compilation (or loading from the
+# on-disk cache) happens at import time, before the first request. nogil
+# lets CPU_POOL threads run them in parallel.
+import numpy as np
+from numba import njit, boolean, float32
+
+@njit(float32[:, :](float32[:, :], float32[:, :]), cache=True, fastmath=True, nogil=True)
+def pairwise_iou(a, b):
+    # a: (N,4), b: (M,4) boxes as [x1, y1, x2, y2] -> (N,M) IOU matrix
+    n = a.shape[0]
+    m = b.shape[0]
+    out = np.empty((n, m), dtype=np.float32)
+    for i in range(n):
+        area_a = (a[i, 2] - a[i, 0]) * (a[i, 3] - a[i, 1])
+        for j in range(m):
+            iw = min(a[i, 2], b[j, 2]) - max(a[i, 0], b[j, 0])
+            ih = min(a[i, 3], b[j, 3]) - max(a[i, 1], b[j, 1])
+            if iw <= 0 or ih <= 0:
+                out[i, j] = 0
+                continue
+            inter = iw * ih
+            area_b = (b[j, 2] - b[j, 0]) * (b[j, 3] - b[j, 1])
+            out[i, j] = inter / (area_a + area_b - inter + 1e-9)
+    return out
+
+@njit(boolean[:](float32[:], float32[:], float32[:], float32[:]), cache=True, fastmath=True, nogil=True)
+def pip_mask(cx, cy, vx, vy):
+    # Even-odd ray casting of (N,) points against polygon vertices (V,) -> (N,) bool
+    n = cx.shape[0]
+    nv = vx.shape[0]
+    out = np.zeros(n, dtype=np.bool_)
+    for p in range(n):
+        x = cx[p]
+        y = cy[p]
+        inside = False
+        j = nv - 1
+        for i in range(nv):
+            if (vy[i] > y) != (vy[j] > y):
+                if x < (vx[j] - vx[i]) * (y - vy[i]) / (vy[j] - vy[i]) + vx[i]:
+                    inside = not inside
+            j = i
+        out[p] = inside
+    return out
@@ -0,0 +1,102 @@
+
+# INT8 ONNX export of the YOLO model for CPU-only hosts.
+# ONNX Runtime's CPU EP runs the quantized graph with VNNI/AMX integer
+# kernels where the hardware has them.
+import os
+import glob
+import shutil
+import numpy as np
+import cv2
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+
+from kernels import pairwise_iou
+
+HEAD_PREFIX = "/model.22/"  # YOLOv8 Detect head: DFL softmax, box decode, final box/score Concat
+MIN_RECALL = 0.9  # Share of FP32 detections the INT8 model must reproduce
+MIN_CALIBRATION_IMAGES = 32  # Real camera frames needed for calibration + held-out validation
+
+class CalibrationReader(CalibrationDataReader):
+    # Feeds letterboxed images to the calibrator, preprocessed like Ultralytics does
+    def __init__(self, image_paths, input_name, imgsz):
+        self.input_name = input_name
+        self.letterbox = LetterBox((imgsz, imgsz), auto=False)
+        self.paths = iter(image_paths)
+
+    def get_next(self):
+        for path in self.paths:
+            img = cv2.imread(path)
+            if img is None:
+                continue
+            img = self.letterbox(image=img)
+            x = img[..., ::-1].transpose(2, 0, 1)[None]  # BGR HWC -> RGB NCHW
+            return {self.input_name: np.ascontiguousarray(x, dtype=np.float32) / 255.0}
+        return None
+
+def calibration_images(calib_dir):
+    # Sample camera frames from calib_dir; stock photos are no calibration set for surveillance footage
+    if not calib_dir:
+        raise ValueError("CALIBRATION_DIR is not set")
+    paths = sorted(p for ext in ("jpg", "jpeg", "png") for p in glob.glob(os.path.join(calib_dir, f"*.{ext}")))
+    if len(paths) < MIN_CALIBRATION_IMAGES:
+        raise ValueError(f"{calib_dir} has {len(paths)} images, need at least {MIN_CALIBRATION_IMAGES}")
+    return paths
+
+def head_nodes(onnx_path):
+    # The head concatenates 0-640 box coordinates with 0-1 class scores; one uint8 scale
+    # over that tensor rounds every score to 0 or ~2.5, so the head stays in float
+    return [n.name for n in onnx.load(onnx_path).graph.node if n.name.startswith(HEAD_PREFIX)]
+
+def detection_recall(ref_path, test_path, image_paths, imgsz, min_iou=0.5):
+    # Reference model's detections the test model finds (same class, IOU >= min_iou) -> (found, total)
+    ref_model = YOLO(ref_path, task="detect")
+    test_model = YOLO(test_path, task="detect")
+    found = total = 0
+    for path in image_paths:
+        ref = ref_model(path, verbose=False, imgsz=imgsz)[0].boxes
+        test = test_model(path, verbose=False, imgsz=imgsz)[0].boxes
+        total += len(ref)
+        if not len(ref) or not len(test):
+            continue
+        iou = pairwise_iou(ref.xyxy.cpu().numpy().astype(np.float32), test.xyxy.cpu().numpy().astype(np.float32))
+        iou[ref.cls.cpu().numpy()[:, None] != test.cls.cpu().numpy()[None, :]] = 0
+        found += int((iou.max(axis=1) >= min_iou).sum())
+    return found, total
+
+def export_int8_onnx(model_name, out_path, imgsz, calib_dir):
+    # Calibrate on most frames, hold the rest out to compare against FP32
+    images = calibration_images(calib_dir)
+    n_val = len(images) // 4
+    calib_images, val_images = images[:-n_val], images[-n_val:]
+
+    # Export the FP32 graph next to out_path (export_atomic's temp dir), not into the CWD
+    weights = shutil.copy(YOLO(model_name).ckpt_path, os.path.dirname(os.path.abspath(out_path)))
+    fp32_path = YOLO(weights).export(format="onnx", dynamic=True, imgsz=imgsz, simplify=False)
+
+    reader = CalibrationReader(calib_images, "images", imgsz)
+    quantize_static(fp32_path, out_path, reader,
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    per_channel=True,
+                    op_types_to_quantize=["Conv"],
+                    nodes_to_exclude=head_nodes(fp32_path))
+
+    # Keep the Ultralytics metadata (class names, stride, imgsz) on the INT8 graph
+    meta = {p.key: p.value for p in onnx.load(fp32_path).metadata_props}
+    int8_model = onnx.load(out_path)
+    onnx.helper.set_model_props(int8_model, meta)
+    onnx.save(int8_model, out_path)
+
+    found, total = detection_recall(fp32_path, out_path, val_images, imgsz)
+    if total == 0:
+        os.remove(out_path)
+        raise ValueError("No FP32 detections on the held-out frames, cannot validate the INT8 model")
+    recall = found / total
+    print(f"INT8 recall vs FP32 on {len(val_images)} held-out frames: {recall:.1%} ({found}/{total})")
+    if recall < MIN_RECALL:
+        os.remove(out_path)
+        raise ValueError(f"INT8 model keeps only {recall:.1%} of FP32 detections (< {MIN_RECALL:.0%})")
+    return out_path